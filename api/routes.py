@@ -1,14 +1,31 @@
-from flask import request, jsonify, Response, stream_with_context
+from flask import request, jsonify, Response, stream_with_context, g
+import hashlib
 import json
 import logging
 import requests
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from utils import upload_base64_image_to_qwenlm, get_image_id_from_upload
-from config import TARGET_API_URL, MODELS_API_URL, COOKIE_VALUE
+from utils import (
+    upload_base64_image_to_qwenlm, get_image_id_from_upload,
+    FileStore, FileNotFoundInStoreError, FileStoreLimitError, TokenBalancer
+)
+from config import (
+    TARGET_API_URL, MODELS_API_URL, COOKIE_VALUE,
+    FILE_EXPIRE_SECONDS, FILE_MAX_BYTES, FILE_MAX_BYTES_PER_OWNER, FILE_STORE_MAX_BYTES,
+    TOKEN_AFFINITY, CONVERSATION_ID_HEADER, TOKEN_LOAD_FACTOR, TOKEN_MIN_CAPACITY, TOKEN_COOLDOWN_SECONDS
+)
 
 # 获取日志记录器
 logger = logging.getLogger(__name__)
 
+# 通过 /v1/files 上传的文件
+file_store = FileStore(FILE_EXPIRE_SECONDS, FILE_MAX_BYTES_PER_OWNER, FILE_STORE_MAX_BYTES)
+
+# 在多个token之间分配请求
+token_balancer = TokenBalancer(
+    load_factor=TOKEN_LOAD_FACTOR, min_capacity=TOKEN_MIN_CAPACITY, cooldown_seconds=TOKEN_COOLDOWN_SECONDS
+)
+
 
 def handle_error(e, error_type=None):
     """统一错误处理函数"""
@@ -20,11 +37,47 @@ def handle_error(e, error_type=None):
     return {'error': error_message}, 500
 
 
-def validate_request(request, get_auth_token):
-    """验证请求数据"""
+def get_file_owner(auth_header):
+    """根据调用方的API密钥计算文件所有者标识，不保存原始密钥"""
+    return hashlib.sha256(auth_header[7:].encode('utf-8')).hexdigest()
+
+
+def is_token_error(upstream_status):
+    """判断上游状态码是否说明token本身出了问题（认证失败、限流或服务端错误），未收到上游响应时返回False"""
+    if upstream_status is None:
+        return False
+    return upstream_status in (401, 403, 429) or upstream_status >= 500
+
+
+def get_conversation_key(request, request_data=None):
+    """获取会话键，用于把同一会话固定到同一token，未开启token亲和时返回None"""
+    if not TOKEN_AFFINITY:
+        return None
+
+    # 优先使用客户端指定的会话键
+    conversation_id = request.headers.get(CONVERSATION_ID_HEADER)
+    if conversation_id:
+        return conversation_id
+
+    messages = (request_data or {}).get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None
+
+    # 系统提示和首条用户消息在同一会话的后续轮次中保持不变
+    leading_messages = []
+    for message in messages:
+        leading_messages.append(message)
+        if isinstance(message, dict) and message.get('role') == 'user':
+            break
+    leading_text = json.dumps(leading_messages, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(leading_text.encode('utf-8')).hexdigest()
+
+
+def validate_request(request, get_auth_tokens):
+    """验证请求数据，成功时选中的token使用完毕后需调用 token_balancer.release"""
     # 验证API key
     auth_header = request.headers.get('Authorization')
-    token, error_message, status_code = get_auth_token(auth_header)
+    token_list, error_message, status_code = get_auth_tokens(auth_header)
     
     if error_message:
         return None, {'error': error_message}, status_code, None
@@ -36,10 +89,15 @@ def validate_request(request, get_auth_token):
         logger.info(f"收到请求: {json.dumps(request_data, ensure_ascii=False)}")
         if not isinstance(request_data, dict):
             return None, {'error': '无效的JSON格式:必须是一个对象'}, 400, None
-        return request_data, None, None, token
+    except RequestEntityTooLarge:
+        return None, {'error': f'请求体大小超出上限: {request.max_content_length}字节'}, 413, None
     except Exception as e:
         return None, {'error': f'无效的JSON格式: {str(e)}'}, 400, None
 
+    # 根据会话键选择token
+    token = token_balancer.select(token_list, get_conversation_key(request, request_data))
+    return request_data, None, None, token
+
 
 def make_api_request(url, method='GET', data=None, stream=False, token_value=None):
     """统一的API请求处理函数"""
@@ -69,6 +127,8 @@ def make_api_request(url, method='GET', data=None, stream=False, token_value=Non
         logger.info(f"{method} 请求到 {url}")
         response = requests.request(method, url, **kwargs)
         logger.info(f"响应状态码: {response.status_code}")
+        # 记录上游实际返回的状态码，与本地构造的错误状态码区分开
+        g.upstream_status = response.status_code
 
         # 处理流式响应
         if stream and response.status_code == 200:
@@ -149,16 +209,20 @@ def process_stream_response(response):
     logger.info("Stream processing completed")
 
 
-def chat_completions_route(get_auth_token):
+def chat_completions_route(get_auth_tokens):
     """处理聊天完成请求的端点"""
     # 验证请求
-    request_data, error_response, status_code, token_value = validate_request(request, get_auth_token)
+    request_data, error_response, status_code, token_value = validate_request(request, get_auth_tokens)
     if error_response:
         return jsonify(error_response), status_code
 
+    # 流式响应在传输结束后才释放token
+    release_on_close = False
+    token_healthy = True
     try:
         # 检查是否为流式请求
         stream_mode = request_data.get('stream', False)
+        file_owner = get_file_owner(request.headers.get('Authorization'))
         
         # 处理多模态消息格式
         if 'messages' in request_data:
@@ -181,36 +245,49 @@ def chat_completions_route(get_auth_token):
                                 image_data = item.get('image_url', '')
                                 # 如果image是对象且包含url字段，提取url值
                                 if isinstance(image_data, dict) and 'url' in image_data:
-                                    image_id=get_image_id_from_upload(upload_base64_image_to_qwenlm(image_data['url'],token_value))
+                                    image_url = image_data['url']
+                                    # 引用已上传的文件时复用QwenLM文件ID，否则上传Base64图片
+                                    if FileStore.is_file_id(image_url):
+                                        image_id = file_store.resolve(image_url, file_owner, token_value)
+                                    else:
+                                        image_id = get_image_id_from_upload(upload_base64_image_to_qwenlm(image_url, token_value))
                                     formatted_content.append({
                                         'image': image_id,  # 提取url字段的值
                                         'type': 'image'
                                     })
                             elif item.get('type') == 'image':
+                                image = item.get('image', '')
+                                if FileStore.is_file_id(image):
+                                    image = file_store.resolve(image, file_owner, token_value)
                                 formatted_content.append({
-                                    'image': item.get('image', ''),
+                                    'image': image,
                                     'type': 'image'
                                 })
                         message['content'] = formatted_content
         
         if stream_mode:
-            # 流式请求处理
-            response, status, headers = make_api_request(
+            # 流式请求处理，失败时只返回 (错误信息, 状态码)
+            result = make_api_request(
                 TARGET_API_URL, 
                 method='POST', 
                 data=request_data, 
                 stream=True,
                 token_value=token_value
             )
+            response, status = result[0], result[1]
             if status != 200:
+                token_healthy = not is_token_error(g.pop('upstream_status', None))
                 return jsonify(response), status
             
             # 使用Flask的stream_with_context处理流式响应
-            return Response(
+            stream_response = Response(
                 stream_with_context(process_stream_response(response)),
                 status=200,
-                headers=headers
+                headers=result[2]
             )
+            stream_response.call_on_close(lambda: token_balancer.release(token_value))
+            release_on_close = True
+            return stream_response
         else:
             # 非流式请求处理
             response, status = make_api_request(
@@ -219,10 +296,17 @@ def chat_completions_route(get_auth_token):
                 data=request_data,
                 token_value=token_value
             )
+            token_healthy = not is_token_error(g.pop('upstream_status', None))
             return jsonify(response), status
+    except FileNotFoundInStoreError as e:
+        logger.error(str(e))
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         error_response, status_code = handle_error(e)
         return jsonify(error_response), status_code
+    finally:
+        if not release_on_close:
+            token_balancer.release(token_value, token_healthy)
 
 
 def models_route():
@@ -235,6 +319,95 @@ def models_route():
         return jsonify(error_response), status_code
 
 
+def files_upload_route(get_auth_tokens):
+    """上传文件的端点，返回可在聊天请求中引用的文件ID"""
+    # 验证API key
+    auth_header = request.headers.get('Authorization')
+    token_list, error_message, status_code = get_auth_tokens(auth_header)
+    if error_message:
+        return jsonify({'error': error_message}), status_code
+
+    try:
+        uploaded_file = request.files.get('file')
+        purpose = request.form.get('purpose', 'vision')
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'请求体大小超出上限: {request.max_content_length}字节'}), 413
+    if uploaded_file is None:
+        return jsonify({'error': '缺少file字段'}), 400
+
+    # 上传的文件只能作为图片在聊天请求中引用
+    content_type = uploaded_file.mimetype or 'image/png'
+    if not content_type.startswith('image/'):
+        return jsonify({'error': f'只支持图片文件，当前类型: {content_type}'}), 400
+
+    # 多读一个字节用于判断是否超出大小上限
+    blob = uploaded_file.read(FILE_MAX_BYTES + 1)
+    if len(blob) > FILE_MAX_BYTES:
+        return jsonify({'error': f'文件大小超出上限: {FILE_MAX_BYTES}字节'}), 413
+
+    # 携带会话键时上传到该会话固定使用的token
+    token = token_balancer.select(token_list, get_conversation_key(request))
+
+    try:
+        # 预先上传到当前token，其他token在首次引用时再上传
+        file_object = file_store.add(
+            blob,
+            get_file_owner(auth_header),
+            filename=uploaded_file.filename or 'image.png',
+            content_type=content_type,
+            purpose=purpose,
+            token=token
+        )
+        return jsonify(file_object), 200
+    except FileStoreLimitError as e:
+        logger.error(str(e))
+        return jsonify({'error': str(e)}), 507
+    except Exception as e:
+        error_response, status_code = handle_error(e, '文件上传')
+        return jsonify(error_response), status_code
+    finally:
+        token_balancer.release(token)
+
+
+def validate_file_owner(get_auth_tokens):
+    """验证API密钥并返回文件所有者标识"""
+    auth_header = request.headers.get('Authorization')
+    _, error_message, status_code = get_auth_tokens(auth_header)
+    if error_message:
+        return None, {'error': error_message}, status_code
+    return get_file_owner(auth_header), None, None
+
+
+def files_list_route(get_auth_tokens):
+    """列出已上传文件的端点"""
+    owner, error_response, status_code = validate_file_owner(get_auth_tokens)
+    if error_response:
+        return jsonify(error_response), status_code
+    return jsonify({'object': 'list', 'data': file_store.list(owner)}), 200
+
+
+def files_retrieve_route(get_auth_tokens, file_id):
+    """获取文件信息的端点"""
+    owner, error_response, status_code = validate_file_owner(get_auth_tokens)
+    if error_response:
+        return jsonify(error_response), status_code
+    file_object = file_store.get(file_id, owner)
+    if file_object is None:
+        return jsonify({'error': f'文件不存在或已过期: {file_id}'}), 404
+    return jsonify(file_object), 200
+
+
+def files_delete_route(get_auth_tokens, file_id):
+    """删除文件的端点"""
+    owner, error_response, status_code = validate_file_owner(get_auth_tokens)
+    if error_response:
+        return jsonify(error_response), status_code
+    deleted = file_store.delete(file_id, owner)
+    if not deleted:
+        return jsonify({'error': f'文件不存在或已过期: {file_id}'}), 404
+    return jsonify({'id': file_id, 'object': 'file', 'deleted': True}), 200
+
+
 def index_route():
     """显示帮助和介绍信息的根目录端点"""
     help_text = """
@@ -302,7 +475,8 @@ def index_route():
         <h2>API Endpoints</h2>
         <div class="endpoint">
             <span>Models:</span> <code>/v1/models</code> <br>
-            <span>Chat:</span> <code>/v1/chat/completions</code>
+            <span>Chat:</span> <code>/v1/chat/completions</code> <br>
+            <span>Files:</span> <code>/v1/files</code>
         </div>
 
         <h3>GitHub: <a href="https://github.com/jyz2012/qwen2api" target="_blank">jyz2012/qwen2api</a></h3>
@@ -1,8 +1,11 @@
 from flask import Flask
 import logging
 
-from config import HOST, PORT, get_auth_token
-from api.routes import chat_completions_route, models_route, index_route
+from config import HOST, PORT, MAX_REQUEST_BYTES, get_auth_tokens
+from api.routes import (
+    chat_completions_route, models_route, index_route,
+    files_upload_route, files_list_route, files_retrieve_route, files_delete_route
+)
 from logger import setup_logging, start_log_cleaner
 
 # 初始化日志
@@ -10,16 +13,33 @@ logger = setup_logging()
 
 # 初始化Flask应用
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
 # 注册路由
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
-    return chat_completions_route(get_auth_token)
+    return chat_completions_route(get_auth_tokens)
 
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     return models_route()
 
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    return files_upload_route(get_auth_tokens)
+
+@app.route('/v1/files', methods=['GET'])
+def list_files():
+    return files_list_route(get_auth_tokens)
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+def retrieve_file(file_id):
+    return files_retrieve_route(get_auth_tokens, file_id)
+
+@app.route('/v1/files/<file_id>', methods=['DELETE'])
+def delete_file(file_id):
+    return files_delete_route(get_auth_tokens, file_id)
+
 @app.route('/', methods=['GET'])
 def index():
     return index_route()
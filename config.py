@@ -1,5 +1,4 @@
 import os
-import random
 
 # API配置
 TARGET_API_URL = 'https://chat.qwen.ai/api/chat/completions'
@@ -10,13 +9,27 @@ COOKIE_VALUE = 'ssxmod_itna=YqjxyiDQDtKQu4iqYQiQGCDce=SqAjeDXDUMqiQGgDYq7=GFKDCO
 LOGS_DIR = os.path.join(os.path.dirname(__file__), 'logs')
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'logging_config.yaml')
 
+# 文件配置
+FILE_EXPIRE_SECONDS = 24 * 3600  # 通过 /v1/files 上传的文件的有效期（秒）
+FILE_MAX_BYTES = 20 * 1024 * 1024  # 单个文件的大小上限（字节）
+FILE_MAX_BYTES_PER_OWNER = 200 * 1024 * 1024  # 每个API密钥可保存的文件总大小（字节）
+FILE_STORE_MAX_BYTES = 1024 * 1024 * 1024  # 内存中保存的文件总大小上限（字节）
+MAX_REQUEST_BYTES = 64 * 1024 * 1024  # 单个请求体的大小上限（字节），聊天请求中的Base64图片也计算在内
+
+# token分配配置
+TOKEN_AFFINITY = os.environ.get('TOKEN_AFFINITY', 'false').lower() in ('1', 'true', 'yes')  # 是否将同一会话固定到同一token
+CONVERSATION_ID_HEADER = 'X-Conversation-Id'  # 客户端指定会话键的请求头
+TOKEN_LOAD_FACTOR = 1.25  # 单个token允许的进行中请求数相对平均值的倍数
+TOKEN_MIN_CAPACITY = 4  # 单个token在被视为过载前至少允许的进行中请求数
+TOKEN_COOLDOWN_SECONDS = 60  # token出错后的冷却时间（秒）
+
 # 服务器配置
 HOST = '0.0.0.0'
 PORT = 6060
 
 # 获取认证令牌
-def get_auth_token(auth_header):
-    """从请求头或环境变量中获取认证令牌"""
+def get_auth_tokens(auth_header):
+    """从请求头或环境变量中获取可用的认证令牌列表"""
     CHAT_AUTHORIZATION = os.environ.get('CHAT_AUTHORIZATION')
     
     # 验证API key格式
@@ -33,10 +46,9 @@ def get_auth_token(auth_header):
         return None, 'API密钥无效或环境变量未设置', 401
     
     try:
-        # 分割密钥字符串并随机选择一个元素
+        # 分割密钥字符串，由调用方从中选择一个元素
         token_list = tokens.split(',')
-        token = random.choice(token_list)
-        return token, None, None
+        return token_list, None, None
     except ValueError:
         # 处理无法分割或列表为空的情况
         return None, 'API密钥格式错误,无法分割', 401
\ No newline at end of file
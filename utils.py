@@ -1,5 +1,12 @@
 import base64
+import bisect
+import hashlib
 import logging
+import math
+import random
+import threading
+import time
+import uuid
 import requests
 from requests_toolbelt import MultipartEncoder
 from typing import Dict, Any, Optional
@@ -19,6 +26,14 @@ class UploadError(ImageProcessingError):
     """上传过程中的异常"""
     pass
 
+class FileNotFoundInStoreError(ImageProcessingError):
+    """文件ID不存在或已过期"""
+    pass
+
+class FileStoreLimitError(ImageProcessingError):
+    """文件存储空间已达上限"""
+    pass
+
 class ImageUtils:
     """处理图像相关操作的工具类"""
     
@@ -173,6 +188,309 @@ class QwenLMUploader:
             raise ValueError("上传结果中未找到图片ID")
         return upload_result['id']
 
+class FileStore:
+    """
+    保存通过 /v1/files 预上传的文件，并记录每个token对应的QwenLM文件ID
+
+    文件内容保存在内存中，同一文件在某个token上第一次被引用时才上传到QwenLM，
+    之后在该token上的引用直接复用已有的QwenLM文件ID。每个文件只对上传它的调用方可见。
+    """
+
+    FILE_ID_PREFIX = 'file-'
+
+    def __init__(self, expire_seconds: int = 86400, max_bytes_per_owner: int = 200 * 1024 * 1024,
+                 max_total_bytes: int = 1024 * 1024 * 1024, uploader: Optional[QwenLMUploader] = None):
+        """
+        初始化文件存储
+
+        参数:
+            expire_seconds (int): 文件的有效期（秒）
+            max_bytes_per_owner (int): 每个所有者可保存的文件总大小（字节）
+            max_total_bytes (int): 所有文件的总大小上限（字节）
+            uploader (QwenLMUploader): 用于上传文件的上传器
+        """
+        self.expire_seconds = expire_seconds
+        self.max_bytes_per_owner = max_bytes_per_owner
+        self.max_total_bytes = max_total_bytes
+        self.uploader = uploader or QwenLMUploader()
+        self._files: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # 每个 (文件ID, token) 一把锁，避免并发请求重复上传同一文件
+        self._upload_locks: Dict[tuple, threading.Lock] = {}
+
+    @classmethod
+    def is_file_id(cls, value: Any) -> bool:
+        """判断一个值是否为本服务生成的文件ID"""
+        return isinstance(value, str) and value.startswith(cls.FILE_ID_PREFIX)
+
+    def _purge_expired(self) -> None:
+        """清理已过期的文件，调用方需持有 self._lock"""
+        now = time.time()
+        expired = [file_id for file_id, entry in self._files.items() if entry['expires_at'] <= now]
+        for file_id in expired:
+            del self._files[file_id]
+            for key in [key for key in self._upload_locks if key[0] == file_id]:
+                del self._upload_locks[key]
+        if expired:
+            logger.info(f"已清理{len(expired)}个过期文件")
+
+    @staticmethod
+    def _to_file_object(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """转换为OpenAI格式的文件对象"""
+        return {
+            'id': entry['id'],
+            'object': 'file',
+            'bytes': len(entry['blob']),
+            'created_at': entry['created_at'],
+            'expires_at': entry['expires_at'],
+            'filename': entry['filename'],
+            'purpose': entry['purpose'],
+        }
+
+    def _get_entry(self, file_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """获取属于指定所有者的文件，调用方需持有 self._lock"""
+        self._purge_expired()
+        entry = self._files.get(file_id)
+        if entry is None or entry['owner'] != owner:
+            return None
+        return entry
+
+    def add(self, blob: bytes, owner: str, filename: str = "image.png", content_type: str = "image/png",
+            purpose: str = "vision", token: Optional[str] = None) -> Dict[str, Any]:
+        """
+        保存文件，如果提供了token则立即上传到该token
+
+        参数:
+            blob (bytes): 文件的二进制数据
+            owner (str): 文件所有者标识
+            filename (str): 文件名
+            content_type (str): 文件的内容类型
+            purpose (str): 文件用途
+            token (str): 认证token，为空时延迟到首次引用时再上传
+
+        返回:
+            Dict[str, Any]: OpenAI格式的文件对象
+
+        异常:
+            FileStoreLimitError: 如果超出存储空间上限
+            UploadError: 如果上传过程中出现错误
+        """
+        now = int(time.time())
+        file_id = f"{self.FILE_ID_PREFIX}{uuid.uuid4().hex}"
+        entry = {
+            'id': file_id,
+            'owner': owner,
+            'blob': blob,
+            'filename': filename,
+            'content_type': content_type,
+            'purpose': purpose,
+            'created_at': now,
+            'expires_at': now + self.expire_seconds,
+            'qwen_ids': {},
+        }
+
+        # 先占用存储空间，避免并发上传同时越过上限
+        with self._lock:
+            self._purge_expired()
+            total_bytes = sum(len(e['blob']) for e in self._files.values())
+            owner_bytes = sum(len(e['blob']) for e in self._files.values() if e['owner'] == owner)
+            if owner_bytes + len(blob) > self.max_bytes_per_owner:
+                raise FileStoreLimitError('已上传文件的总大小超出上限，请删除部分文件后重试')
+            if total_bytes + len(blob) > self.max_total_bytes:
+                raise FileStoreLimitError('文件存储空间已满，请稍后重试')
+            self._files[file_id] = entry
+
+        if token:
+            try:
+                upload_data = self.uploader.upload_blob(blob, token, filename, content_type)
+                entry['qwen_ids'][token] = QwenLMUploader.get_image_id_from_upload(upload_data)
+            except Exception:
+                with self._lock:
+                    self._files.pop(file_id, None)
+                raise
+        logger.info(f"已保存文件: {file_id}, 大小: {len(blob)}字节")
+        return self._to_file_object(entry)
+
+    def get(self, file_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """获取文件对象，文件不存在、已过期或不属于该所有者时返回None"""
+        with self._lock:
+            entry = self._get_entry(file_id, owner)
+            return self._to_file_object(entry) if entry else None
+
+    def list(self, owner: str) -> list:
+        """列出属于该所有者的所有未过期文件对象"""
+        with self._lock:
+            self._purge_expired()
+            return [self._to_file_object(entry) for entry in self._files.values() if entry['owner'] == owner]
+
+    def delete(self, file_id: str, owner: str) -> bool:
+        """删除文件，返回文件是否存在"""
+        with self._lock:
+            if self._get_entry(file_id, owner) is None:
+                return False
+            for key in [key for key in self._upload_locks if key[0] == file_id]:
+                del self._upload_locks[key]
+            del self._files[file_id]
+            return True
+
+    def resolve(self, file_id: str, owner: str, token: str) -> str:
+        """
+        获取文件在指定token下的QwenLM文件ID，如果尚未上传则先上传
+
+        参数:
+            file_id (str): 本服务生成的文件ID
+            owner (str): 文件所有者标识
+            token (str): 认证token
+
+        返回:
+            str: QwenLM文件ID
+
+        异常:
+            FileNotFoundInStoreError: 如果文件不存在或已过期
+            UploadError: 如果上传过程中出现错误
+        """
+        with self._lock:
+            entry = self._get_entry(file_id, owner)
+            if entry is None:
+                raise FileNotFoundInStoreError(f"文件不存在或已过期: {file_id}")
+            qwen_id = entry['qwen_ids'].get(token)
+            if qwen_id:
+                return qwen_id
+            upload_lock = self._upload_locks.setdefault((file_id, token), threading.Lock())
+
+        with upload_lock:
+            # 等待锁期间可能已被其他请求上传
+            qwen_id = entry['qwen_ids'].get(token)
+            if qwen_id:
+                return qwen_id
+            logger.info(f"文件 {file_id} 在当前token下尚未上传，开始上传")
+            upload_data = self.uploader.upload_blob(entry['blob'], token, entry['filename'], entry['content_type'])
+            qwen_id = QwenLMUploader.get_image_id_from_upload(upload_data)
+            entry['qwen_ids'][token] = qwen_id
+            return qwen_id
+
+class TokenBalancer:
+    """
+    在多个token之间分配请求
+
+    未提供会话键时随机选择token；提供会话键时通过一致性哈希把同一会话固定到同一token，
+    只有在该token不健康或负载过高时才顺着哈希环移到下一个token，使各token的负载保持均衡。
+    """
+
+    def __init__(self, virtual_nodes: int = 100, load_factor: float = 1.25, min_capacity: int = 4,
+                 cooldown_seconds: int = 60):
+        """
+        初始化负载均衡器
+
+        参数:
+            virtual_nodes (int): 每个token在哈希环上的虚拟节点数
+            load_factor (float): 单个token允许的进行中请求数相对平均值的倍数
+            min_capacity (int): 单个token在被视为过载前至少允许的进行中请求数
+            cooldown_seconds (int): token被标记为不健康后的冷却时间（秒）
+        """
+        self.virtual_nodes = virtual_nodes
+        self.load_factor = load_factor
+        self.min_capacity = min_capacity
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._rings: Dict[tuple, tuple] = {}
+        self._inflight: Dict[str, int] = {}
+        self._unhealthy_until: Dict[str, float] = {}
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        """计算哈希环上的位置"""
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def _get_ring(self, tokens: tuple) -> tuple:
+        """获取token列表对应的哈希环，调用方需持有 self._lock"""
+        ring = self._rings.get(tokens)
+        if ring is None:
+            # token列表通常是固定的几组，超出时直接清空缓存
+            if len(self._rings) >= 32:
+                self._rings.clear()
+            nodes = sorted(
+                (self._hash(f"{token}#{i}"), token)
+                for token in set(tokens)
+                for i in range(self.virtual_nodes)
+            )
+            ring = ([node[0] for node in nodes], [node[1] for node in nodes])
+            self._rings[tokens] = ring
+        return ring
+
+    def _prune_cooldowns(self, now: float) -> None:
+        """清理已结束的冷却期，调用方需持有 self._lock"""
+        for expired in [t for t, until in self._unhealthy_until.items() if until <= now]:
+            del self._unhealthy_until[expired]
+
+    def _is_healthy(self, token: str, now: float) -> bool:
+        """判断token是否不在冷却期内，调用方需持有 self._lock"""
+        return self._unhealthy_until.get(token, 0) <= now
+
+    def _ring_order(self, tokens: tuple, key: str) -> list:
+        """按哈希环顺时针方向列出会话键之后的各个token，调用方需持有 self._lock"""
+        hashes, owners = self._get_ring(tokens)
+        start = bisect.bisect(hashes, self._hash(key))
+        ordered = []
+        for i in range(len(owners)):
+            token = owners[(start + i) % len(owners)]
+            if token not in ordered:
+                ordered.append(token)
+        return ordered
+
+    def select(self, tokens: list, key: Optional[str] = None) -> str:
+        """
+        选择一个token并记为进行中，使用完毕后需调用 release
+
+        参数:
+            tokens (list): 可用的token列表
+            key (str): 会话键，为空时随机选择
+
+        返回:
+            str: 选中的token
+        """
+        with self._lock:
+            if key is None:
+                token = random.choice(tokens)
+            else:
+                now = time.time()
+                ordered = self._ring_order(tuple(tokens), key)
+                total = sum(self._inflight.get(t, 0) for t in ordered)
+                # 负载较低时不因少量并发请求而切换token
+                capacity = max(math.ceil(self.load_factor * (total + 1) / len(ordered)), self.min_capacity)
+                available = [t for t in ordered if self._inflight.get(t, 0) < capacity]
+                healthy = [t for t in available if self._is_healthy(t, now)]
+                # 优先选择健康且未过载的token，都不满足时退而求其次
+                token = (healthy or available or ordered)[0]
+                if token != ordered[0]:
+                    logger.info(f"会话 {key[:16]} 的首选token不可用，已切换到哈希环上的下一个token")
+            self._inflight[token] = self._inflight.get(token, 0) + 1
+            return token
+
+    def release(self, token: str, healthy: bool = True) -> None:
+        """
+        结束一次请求，token出错时进入冷却期
+
+        冷却期只会自然结束，不会被成功的请求提前清除，
+        以免出错前就已开始的长时间流式请求在结束时抹掉刚记录的错误。
+
+        参数:
+            token (str): select 返回的token
+            healthy (bool): 本次请求中token是否正常
+        """
+        with self._lock:
+            # token列表可能由调用方提供，每次都清理以免冷却记录无限增长
+            now = time.time()
+            self._prune_cooldowns(now)
+            inflight = self._inflight.get(token, 0) - 1
+            if inflight > 0:
+                self._inflight[token] = inflight
+            else:
+                self._inflight.pop(token, None)
+            if not healthy:
+                self._unhealthy_until[token] = now + self.cooldown_seconds
+                logger.warning(f"token被标记为不健康，{self.cooldown_seconds}秒内尽量不再分配会话")
+
 # 为了保持向后兼容性，提供与原始API相同的函数
 def base64_to_bytes(base64_image: str) -> bytes:
     """向后兼容的函数，调用ImageUtils.base64_to_bytes"""